@@ -5,9 +5,18 @@ from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from models import DiagnosisResponse, ErrorResponse
-from fireworks_client import FireworksClient
+from batcher import DiagnosisBatcher
 import logging
+import asyncio
+import importlib
+import hashlib
+import weakref
+from cachetools import TTLCache
+from PIL import Image
+import io
 from typing import Union
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
 
@@ -22,16 +31,52 @@ logger = logging.getLogger(__name__)
 # Fireworks AI is used for vision analysis
 AI_BACKEND = "FIREWORKS"
 
+# Backend name -> (module, class). Client modules are imported only when
+# selected, so unused backends cost nothing at startup.
+_BACKENDS = {
+    "FIREWORKS": ("fireworks_client", "FireworksClient"),
+}
+
 # File validation settings
 ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png", "image/webp"]
 MAX_FILE_SIZE_MB = 10
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Image decode/resize/encode is CPU-bound, so cap it at one thread per core,
+# shared between the server processes (serve.py sets WEB_CONCURRENCY)
+IMAGE_POOL_WORKERS = max(1, (os.cpu_count() or 4) // int(os.environ.get("WEB_CONCURRENCY") or 1))
+
+# Diagnosis cache: identical re-uploads are answered without calling Fireworks
+DIAGNOSIS_CACHE_SIZE = 1024
+DIAGNOSIS_CACHE_TTL_SECONDS = 3600
+
+# Request batching: concurrent uploads arriving within BATCH_LINGER_MS are
+# sent to Fireworks as one multi-image call of up to MAX_BATCH_SIZE images
+MAX_BATCH_SIZE = 4
+BATCH_LINGER_MS = 50
 
 # --- App Initialization ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the request batcher, and releases it, the AI client's connection
+    pool and the image workers on shutdown.
+    """
+    if batcher:
+        await batcher.start()
+    yield
+    if batcher:
+        await batcher.stop()
+    if ai_client:
+        await ai_client.aclose()
+    image_pool.shutdown(wait=False)
+
 app = FastAPI(
     title="Skin Disease Checker API",
     description="AI-powered skin image analysis",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -42,15 +87,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Shared, bounded pool for Pillow preprocessing
+image_pool = ThreadPoolExecutor(
+    max_workers=IMAGE_POOL_WORKERS, thread_name_prefix="img"
+)
+
 def get_ai_client():
     """Factory function to get the appropriate AI client."""
-    if AI_BACKEND == "FIREWORKS":
-        return FireworksClient()
-    else:
+    if AI_BACKEND not in _BACKENDS:
         raise ValueError(
-            f"Invalid AI_BACKEND: {AI_BACKEND}. Only FIREWORKS is supported."
+            f"Invalid AI_BACKEND: {AI_BACKEND}. Supported: {', '.join(_BACKENDS)}."
         )
 
+    module_name, class_name = _BACKENDS[AI_BACKEND]
+    client_class = getattr(importlib.import_module(module_name), class_name)
+    return client_class(executor=image_pool)
+
 # Initialize a single, reusable instance of the AI client
 try:
     ai_client = get_ai_client()
@@ -59,6 +111,43 @@ except Exception as e:
     logger.error(f"Failed to initialize AI client: {e}")
     ai_client = None
 
+batcher = (
+    DiagnosisBatcher(ai_client, max_batch_size=MAX_BATCH_SIZE, linger_ms=BATCH_LINGER_MS)
+    if ai_client else None
+)
+
+# Content-addressed cache of diagnoses, plus one lock per image digest so
+# identical concurrent uploads wait for a single Fireworks call
+diagnosis_cache = TTLCache(maxsize=DIAGNOSIS_CACHE_SIZE, ttl=DIAGNOSIS_CACHE_TTL_SECONDS)
+diagnosis_locks = weakref.WeakValueDictionary()
+
+def _file_too_large(size: int) -> HTTPException:
+    logger.warning(f"File uploaded exceeds size limit: {size} bytes")
+    return HTTPException(
+        # Literal code: Starlette renamed the 413 constant, and older releases
+        # allowed by the fastapi requirement lack HTTP_413_CONTENT_TOO_LARGE
+        status_code=413,
+        detail=f"File size exceeds limit of {MAX_FILE_SIZE_MB} MB."
+    )
+
+async def read_upload(file: UploadFile) -> bytes:
+    """
+    Reads the upload in chunks, rejecting it as soon as it exceeds
+    MAX_FILE_SIZE_BYTES instead of buffering the whole body first.
+    """
+    declared_size = file.size
+    if declared_size is None and file.headers.get("content-length", "").isdigit():
+        declared_size = int(file.headers["content-length"])
+    if declared_size is not None and declared_size > MAX_FILE_SIZE_BYTES:
+        raise _file_too_large(declared_size)
+
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > MAX_FILE_SIZE_BYTES:
+            raise _file_too_large(len(buffer))
+    return bytes(buffer)
+
 # --- API Endpoints ---
 
 @app.get("/", include_in_schema=False)
@@ -111,33 +200,55 @@ async def diagnose_skin(
             detail=f"Invalid file type. Please upload a JPEG, PNG, or WEBP image."
         )
 
-    image_bytes = await file.read()
-    if len(image_bytes) > MAX_FILE_SIZE_BYTES:
-        logger.warning(f"File uploaded exceeds size limit: {len(image_bytes)} bytes")
+    image_bytes = await read_upload(file)
+
+    # Cheap header/structure check so garbage never reaches a full decode
+    try:
+        Image.open(io.BytesIO(image_bytes)).verify()
+    except Exception as e:
+        logger.warning(f"Corrupt or unreadable image uploaded: {file.filename}: {e}")
         raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_PAYLOAD_TOO_LARGE,
-            detail=f"File size exceeds limit of {MAX_FILE_SIZE_MB} MB."
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Corrupt image. Please upload a valid JPEG, PNG, or WEBP image."
         )
     
     logger.info(f"Received file: {file.filename}, Size: {len(image_bytes)} bytes")
 
-    try:
-        # Call the synchronous method from our client
-        diagnosis_data = ai_client.diagnose_skin_image(image_bytes)
-        
-        # Validate the data with our Pydantic model
-        response = DiagnosisResponse(**diagnosis_data)
-        logger.info(f"Successfully diagnosed image: {file.filename}")
-        
+    cache_key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    cached = diagnosis_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Returning cached diagnosis for image: {file.filename}")
+        return cached
+
+    lock = diagnosis_locks.get(cache_key)
+    if lock is None:
+        lock = diagnosis_locks[cache_key] = asyncio.Lock()
+
+    async with lock:
+        # Another request for the same image may have finished while we waited
+        cached = diagnosis_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Returning cached diagnosis for image: {file.filename}")
+            return cached
+
+        try:
+            # Queue the image; concurrent uploads share one Fireworks call
+            diagnosis_data = await batcher.submit(image_bytes, file.content_type)
+
+            # Validate the data with our Pydantic model
+            response = DiagnosisResponse(**diagnosis_data)
+            logger.info(f"Successfully diagnosed image: {file.filename}")
+
+        except Exception as e:
+            logger.error(f"AI analysis failed for file {file.filename}: {e}", exc_info=True)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"An internal error occurred during AI analysis. Error: {e}"
+            )
+
+        diagnosis_cache[cache_key] = response
         return response
 
-    except Exception as e:
-        logger.error(f"AI analysis failed for file {file.filename}: {e}", exc_info=True)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"An internal error occurred during AI analysis. Error: {e}"
-        )
-
 if __name__ == "__main__":
     # This part runs if you were to execute `python app.py`
     # Run the FastAPI app directly
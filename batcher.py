@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A queued request: image bytes, content type, and the future its handler awaits
+BatchItem = Tuple[bytes, Optional[str], asyncio.Future]
+
+
+class DiagnosisBatcher:
+    """
+    Coalesces /diagnose requests that arrive close together into a single
+    multi-image call on the AI client.
+    """
+
+    def __init__(self, ai_client, max_batch_size: int = 4, linger_ms: int = 50):
+        """
+        `ai_client` must provide diagnose_skin_images() and diagnose_skin_image().
+        A batch is sent once it holds `max_batch_size` images or `linger_ms`
+        after its first image arrived, whichever comes first.
+        """
+        self.ai_client = ai_client
+        self.max_batch_size = max_batch_size
+        self.linger_seconds = linger_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._dispatches: set = set()
+
+    async def start(self) -> None:
+        """Start the background batching loop on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop batching and fail any requests still waiting in the queue."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        while self._queue and not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Diagnosis service is shutting down."))
+
+    async def submit(self, image_bytes: bytes, content_type: Optional[str] = None) -> Dict[str, Any]:
+        """Queue one image and wait for its diagnosis dict."""
+        if self._task is None:
+            # Not started (e.g. outside the app lifespan): diagnose directly
+            return await self.ai_client.diagnose_skin_image(image_bytes, content_type)
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image_bytes, content_type, future))
+        return await future
+
+    async def _run(self) -> None:
+        """Collect queued items into batches and dispatch them concurrently."""
+        while True:
+            batch = [await self._queue.get()]
+
+            # Give concurrent requests a short window to join, unless a
+            # full batch is already waiting.
+            if self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.linger_seconds)
+
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch: List[BatchItem]) -> None:
+        """Send one batch, falling back to per-image calls if it fails."""
+        # Skip requests whose handler has already gone away
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+
+        try:
+            results = await self.ai_client.diagnose_skin_images(
+                [(image_bytes, content_type) for image_bytes, content_type, _ in batch]
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                logger.warning(f"Batched diagnosis of {len(batch)} images failed, retrying individually: {e}")
+                await asyncio.gather(*(self._dispatch([item]) for item in batch))
+            else:
+                self._resolve(batch[0][2], exception=e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            self._resolve(future, result=result)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any = None, exception: Optional[BaseException] = None) -> None:
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
@@ -1,52 +1,174 @@
+import asyncio
 import base64
 import httpx
-from PIL import Image
+from concurrent.futures import Executor
+from PIL import Image, ImageOps
+from pydantic import ValidationError
+from models import DiagnosisResponse, DIAGNOSIS_SCHEMA
 import io
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Tuple
 import json
+import orjson
 import re
 import os
+import logging
+import hashlib
+import struct
+from collections import OrderedDict
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # libvips is optional; without it images are processed with Pillow
+    pyvips = None
+
+logger = logging.getLogger(__name__)
 
 # This is the prompt that forces the AI to give us the
-# "classification" output you wanted.
+# "classification" output you wanted. Single-image requests also constrain
+# decoding to the DiagnosisResponse JSON schema via response_format.
 PROMPT_TEMPLATE = """
 You are a specialized medical AI. Analyze the provided image of a skin condition.
-Respond *only* in the following format, with no other text:
+Respond *only* with a JSON object of the following form, with no other text:
+{"status": "healthy" or "unhealthy", "confidence": [a float number between 0.0 and 1.0], "disease": [Name of disease, or "None"], "disease_confidence": [a float number between 0.0 and 1.0, or 0.0]}
+"""
+
+# Prompt for a multi-image request; each answer is introduced by a separator
+# line so the response can be split back into one diagnosis per image.
+BATCH_PROMPT_TEMPLATE = """
+You are a specialized medical AI. You are given {count} images of skin conditions, in order.
+Analyze each image independently of the others.
+For each image, numbered from 1 to {count}, respond *only* in the following format, with no other text:
+--- ITEM [image number] ---
 STATUS: [healthy/unhealthy]
 CONFIDENCE: [a float number between 0.0 and 1.0]
 DISEASE: [Name of disease, or "None"]
 DISEASE_CONFIDENCE: [a float number between 0.0 and 1.0, or 0.0]
 """
 
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+
+# Image preprocessing limits
+MAX_IMAGE_DIMENSION = 2048
+MAX_IMAGE_SIZE_KB = 500
+JPEG_QUALITY_STEPS = (85, 70, 55)
+
+# Response field patterns, compiled once at import
+_STATUS_RE = re.compile(r"STATUS:\s*(healthy|unhealthy)", re.IGNORECASE)
+# Be more specific - match CONFIDENCE but not DISEASE_CONFIDENCE
+_CONF_RE = re.compile(r"(?<!DISEASE_)CONFIDENCE:\s*(\d+\.\d+)", re.IGNORECASE)
+_DISEASE_RE = re.compile(r"DISEASE:\s*([^\n]+?)(?=\s*DISEASE_CONFIDENCE|\s*$)", re.IGNORECASE)
+_DISEASE_CONF_RE = re.compile(r"DISEASE_CONFIDENCE:\s*(\d+\.\d+)", re.IGNORECASE)
+_ITEM_SEPARATOR_RE = re.compile(r"^[\s*#]*-{3}\s*ITEM\s*(\d+)\s*-{3}[\s*]*$", re.IGNORECASE | re.MULTILINE)
+
+# JPEG uploads at or under this size are sent as-is, skipping Pillow entirely
+FAST_PATH_MAX_BYTES = MAX_IMAGE_SIZE_KB * 1024
+
+# The answer is four short lines (~60 tokens) per image
+MAX_TOKENS_PER_IMAGE = 128
+
+# Number of prepared data URLs kept for retries of the same image
+DATA_URL_CACHE_SIZE = 32
+
+def _jpeg_dims(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Read (width, height) from a JPEG's SOF marker without decoding it.
+    Returns None if the bytes aren't a JPEG, no frame header is found, or
+    the file carries metadata (any APPn segment other than the APP0 JFIF
+    header, or a comment). EXIF, XMP, ICC and IPTC all come before the
+    frame header, so the same scan finds them.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return None
+
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # Fill byte before a marker
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # Markers without a length
+            offset += 2
+            continue
+
+        # SOF0..SOF15, excluding DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return width, height
+
+        if 0xE1 <= marker <= 0xEF or marker == 0xFE:  # APP1..APP15, COM
+            return None
+
+        (segment_length,) = struct.unpack(">H", data[offset + 2:offset + 4])
+        offset += 2 + segment_length
+    return None
+
+
 class FireworksClient:
     """Handles communication with Fireworks AI API"""
 
-    def __init__(self, model_name: str = "accounts/fireworks/models/qwen3-vl-30b-a3b-thinking"):
+    def __init__(
+        self,
+        model_name: str = "accounts/fireworks/models/qwen3-vl-30b-a3b-instruct",
+        executor: Optional[Executor] = None
+    ):
         """
         Initializes the Fireworks AI client.
+        Image preprocessing runs on `executor`, or the loop's default pool if None.
         """
         self.model_name = model_name
-        self.api_url = "https://api.fireworks.ai/inference/v1/chat/completions"
+        self.executor = executor
+        # LRU of image digest -> data URL, so a retried image skips JPEG + base64
+        self._data_url_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self.api_url = "/inference/v1/chat/completions"
         self.api_key = os.environ.get("FIREWORKS_API_KEY")
 
         if not self.api_key:
             raise Exception("FIREWORKS_API_KEY environment variable is required")
 
-        self.client = httpx.Client(timeout=120.0)  # Longer timeout for vision models
+        # One long-lived HTTP/2 pool: concurrent diagnoses are multiplexed over a
+        # warm connection instead of paying TCP + TLS setup on every call.
+        self.client = httpx.AsyncClient(
+            base_url="https://api.fireworks.ai",
+            http2=True,
+            timeout=httpx.Timeout(120.0, connect=5.0),  # Longer timeout for vision models
+            limits=httpx.Limits(
+                max_keepalive_connections=32,
+                max_connections=64,
+                keepalive_expiry=60.0
+            ),
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.api_key}"
+            }
+        )
+
+    async def aclose(self) -> None:
+        """Close the underlying HTTP connection pool."""
+        await self.client.aclose()
 
-    def diagnose_skin_image(self, image_bytes: bytes) -> Dict[str, Any]:
+    async def diagnose_skin_image(
+        self, image_bytes: bytes, content_type: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
         Main method: takes image bytes, returns diagnosis dict
         """
         try:
             # 1. Convert image to URL
-            image_url = self._image_to_url(image_bytes)
+            image_url = await self._prepare_image_url(image_bytes, content_type)
 
             # 2. Build the API payload
-            payload = self._build_payload(image_url)
+            payload = self._build_payload([image_url])
 
-            # 3. Send to Fireworks
-            raw_ai_text = self._call_fireworks_api(payload)
+            # 3. Send to Fireworks, stopping the stream once the answer is complete
+            raw_ai_text = await self._call_fireworks_api(
+                payload, is_complete=self._has_all_fields
+            )
 
             # 4. Parse response
             structured_data = self._parse_response(raw_ai_text)
@@ -62,121 +184,377 @@ class FireworksClient:
             # Catch all other errors (parsing, etc.)
             raise Exception(f"An error occurred during analysis: {e}")
 
+    async def diagnose_skin_images(
+        self, images: List[Tuple[bytes, Optional[str]]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Diagnose several (image bytes, content type) pairs with one
+        multi-image Fireworks call. Returns one diagnosis dict per image,
+        in order. Raises if the response can't be split per image, in
+        which case callers should fall back to diagnose_skin_image.
+        """
+        if len(images) == 1:
+            return [await self.diagnose_skin_image(*images[0])]
+
+        image_urls = await asyncio.gather(
+            *(self._prepare_image_url(image_bytes, content_type)
+              for image_bytes, content_type in images)
+        )
+        prompt = BATCH_PROMPT_TEMPLATE.format(count=len(image_urls))
+        payload = self._build_payload(image_urls, prompt=prompt)
+        raw_ai_text = await self._call_fireworks_api(payload)
+        return self._parse_batch_response(raw_ai_text, len(image_urls))
+
+    async def _prepare_image_url(
+        self, image_bytes: bytes, content_type: Optional[str]
+    ) -> str:
+        """Return the image's data URL, running any Pillow work off the event loop."""
+        cache_key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+        image_url = self._data_url_cache.get(cache_key)
+        if image_url is not None:
+            self._data_url_cache.move_to_end(cache_key)
+            return image_url
+
+        image_url = self._fast_jpeg_data_url(image_bytes, content_type)
+        if image_url is None:
+            loop = asyncio.get_running_loop()
+            image_url = await loop.run_in_executor(
+                self.executor, self._image_to_url, image_bytes
+            )
+
+        self._data_url_cache[cache_key] = image_url
+        if len(self._data_url_cache) > DATA_URL_CACHE_SIZE:
+            self._data_url_cache.popitem(last=False)
+        return image_url
+
+    def _fast_jpeg_data_url(
+        self, image_bytes: bytes, content_type: Optional[str]
+    ) -> Optional[str]:
+        """
+        Return a data URL for small JPEG uploads without re-encoding them,
+        or None when the image has to go through _image_to_url.
+        Dimensions come from the JPEG header, so Pillow is never touched here.
+        JPEGs with EXIF or other metadata are re-encoded instead, so GPS
+        tags and the like are never forwarded.
+        """
+        if content_type != "image/jpeg" or len(image_bytes) > FAST_PATH_MAX_BYTES:
+            return None
+
+        dims = _jpeg_dims(image_bytes)
+        if dims is None or max(dims) > MAX_IMAGE_DIMENSION:
+            return None
+        return self._encode_data_url(image_bytes)
+
     def _image_to_url(self, image_bytes: bytes) -> str:
         """
         Process image and return data URL for Fireworks API.
         Fireworks may support data URLs directly.
         """
+        if pyvips is not None:
+            try:
+                return self._encode_data_url(self._vips_to_jpeg(image_bytes))
+            except pyvips.Error as e:
+                logger.debug(f"libvips could not process image, falling back to Pillow: {e}")
+
         img = Image.open(io.BytesIO(image_bytes))
 
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
+        # Bound the dimensions once up front (thumbnail keeps the aspect ratio
+        # and lets libjpeg decode large JPEGs at a reduced scale)
+        img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+
+        # Bake the EXIF orientation into the pixels. The JPEG save below
+        # only embeds EXIF/ICC data when passed explicitly, so none is sent.
+        ImageOps.exif_transpose(img, in_place=True)
+
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
 
-        max_size_kb = 500
-        quality = 85
-        while True:
+        # Step quality down only while the encode is over budget,
+        # so at most len(JPEG_QUALITY_STEPS) encodes per image.
+        for quality in JPEG_QUALITY_STEPS:
             img_buffer = io.BytesIO()
-            img.save(img_buffer, format="JPEG", quality=quality)
-            size_kb = len(img_buffer.getvalue()) / 1024
+            img.save(
+                img_buffer,
+                format="JPEG",
+                quality=quality,
+                optimize=True,
+                progressive=True,
+                subsampling="4:2:0"
+            )
+            size_kb = img_buffer.tell() / 1024  # No copy needed just to measure
 
-            if size_kb <= max_size_kb or quality <= 10:
+            if size_kb <= MAX_IMAGE_SIZE_KB:
                 break
 
-            width, height = img.size
-            img = img.resize((int(width * 0.9), int(height * 0.9)), Image.LANCZOS)
-            quality -= 5
+        # Encode straight from the buffer's memory instead of a getvalue() copy
+        with img_buffer.getbuffer() as jpeg_view:
+            return self._encode_data_url(jpeg_view)
+
+    def _vips_to_jpeg(self, image_bytes: bytes) -> bytes:
+        """
+        Resize and re-encode with libvips. thumbnail_buffer uses JPEG
+        shrink-on-load, so large photos are never decoded at full resolution.
+        """
+        img = pyvips.Image.thumbnail_buffer(
+            image_bytes, MAX_IMAGE_DIMENSION, height=MAX_IMAGE_DIMENSION, size="down"
+        )
+
+        if img.hasalpha():
+            img = img.flatten()
+        if img.interpretation not in ("srgb", "b-w"):
+            img = img.colourspace("srgb")
 
-        # Convert to base64 for data URL
-        base64_data = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+        # The pipeline is streamed from the source buffer; render the small
+        # result once so the quality steps don't re-run the decode.
+        img = img.copy_memory()
 
-        # Return data URL directly - Fireworks might support this
-        return f"data:image/jpeg;base64,{base64_data}"
+        for quality in JPEG_QUALITY_STEPS:
+            jpeg_bytes = img.jpegsave_buffer(
+                Q=quality, optimize_coding=True, interlace=True, strip=True
+            )
+            if len(jpeg_bytes) / 1024 <= MAX_IMAGE_SIZE_KB:
+                break
+        return jpeg_bytes
 
+    def _encode_data_url(self, jpeg_bytes) -> str:
+        """
+        Build a JPEG data URL from any bytes-like object, base64-encoding
+        directly into the prefixed output buffer.
+        """
+        data_url = bytearray(DATA_URL_PREFIX)
+        data_url += base64.b64encode(jpeg_bytes)
+        return data_url.decode("ascii")
 
-    def _build_payload(self, image_url: str) -> Dict[str, Any]:
+    def _build_payload(
+        self, image_urls: List[str], prompt: str = PROMPT_TEMPLATE
+    ) -> Dict[str, Any]:
         """Create the structured payload for Fireworks API"""
-        return {
+        payload = {
             "model": self.model_name,
-            "max_tokens": 1000,
-            "top_p": 1,
+            "max_tokens": MAX_TOKENS_PER_IMAGE * len(image_urls),
+            "top_p": 0.9,
             "top_k": 40,
             "presence_penalty": 0,
             "frequency_penalty": 0,
-            "temperature": 0.6,
+            "temperature": 0.1,
+            "stream": True,
             "messages": [
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": PROMPT_TEMPLATE
+                            "text": prompt
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url
+                        *(
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": image_url
+                                }
                             }
-                        }
+                            for image_url in image_urls
+                        )
                     ]
                 }
             ]
         }
 
-    def _call_fireworks_api(self, payload: Dict[str, Any]) -> str:
-        """Send request to Fireworks API and get the raw text response"""
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        # Grammar-constrained JSON for single images; batches use ITEM sections
+        if len(image_urls) == 1:
+            payload["response_format"] = {
+                "type": "json_object",
+                "schema": DIAGNOSIS_SCHEMA
+            }
+        return payload
+
+    async def _call_fireworks_api(
+        self,
+        payload: Dict[str, Any],
+        is_complete: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        """
+        Send a streaming request to Fireworks API and get the raw text response.
+        If `is_complete` returns True for the text received so far, the stream
+        is closed early instead of waiting for the model to finish.
+        """
+        parts: List[str] = []
+        # orjson serializes the large base64 data URL far faster than stdlib json
+        async with self.client.stream(
+            "POST", self.api_url, content=orjson.dumps(payload)
+        ) as response:
+            if response.is_error:
+                await response.aread()  # Make the error body available to callers
+            response.raise_for_status()
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
 
-        response = self.client.post(self.api_url, json=payload, headers=headers)
-        response.raise_for_status()
+                choices = orjson.loads(data).get("choices") or []
+                if not choices:
+                    continue
+                content = (choices[0].get("delta") or {}).get("content")
+                if not content:
+                    continue
 
-        raw_data = response.json()
-        choices = raw_data.get("choices", [])
-        if not choices:
-            raise ValueError("Fireworks returned no choices")
+                parts.append(content)
+                # Only a closing brace or a line break can complete the answer
+                if (
+                    is_complete
+                    and ("}" in content or "\n" in content)
+                    and is_complete("".join(parts))
+                ):
+                    break
 
-        ai_text_response = choices[0].get("message", {}).get("content", "")
+        ai_text_response = "".join(parts)
 
         if not ai_text_response:
             raise ValueError("Fireworks returned an empty response.")
 
         return ai_text_response
 
+    def _has_all_fields(self, response_text: str) -> bool:
+        """
+        True once the whole answer has arrived: a complete JSON diagnosis, or
+        every field on a complete line.
+        """
+        if "<think>" in response_text and "</think>" not in response_text:
+            return False  # Still reasoning; STATUS lines here are drafts
+
+        answer = response_text.split("</think>")[-1]
+        if answer.lstrip().startswith("{"):
+            # The chunk holding the closing brace may carry a few more characters
+            try:
+                DiagnosisResponse.model_validate(orjson.loads(answer[:answer.rfind("}") + 1]))
+                return True
+            except (orjson.JSONDecodeError, ValidationError):
+                return False
+
+        complete_lines = answer[:answer.rfind("\n") + 1]
+        return len(self._parse_lines(complete_lines)) == 4
+
     def _parse_response(self, response_text: str) -> Dict[str, Any]:
         """
-        Extract structured data from AI response using regex.
+        Extract structured data from AI response. The JSON answer is
+        validated against DiagnosisResponse, and a JSON answer that fails
+        validation is an error. Plain-text answers are parsed line by line
+        with a regex fallback.
         """
         try:
             # Remove thinking tags and extract final response
             if "</think>" in response_text:
                 response_text = response_text.split("</think>")[-1].strip()
 
-            # Use findall to get all matches, then take the last one (most final)
-            status_matches = re.findall(r"STATUS:\s*(healthy|unhealthy)", response_text, re.IGNORECASE)
-            # Be more specific - match CONFIDENCE but not DISEASE_CONFIDENCE
-            confidence_matches = re.findall(r"(?<!DISEASE_)CONFIDENCE:\s*([\d]+\.[\d]+)", response_text, re.IGNORECASE)
-            disease_matches = re.findall(r"DISEASE:\s*([^\n]+?)(?=\s*DISEASE_CONFIDENCE|\s*$)", response_text, re.IGNORECASE)
-            disease_conf_matches = re.findall(r"DISEASE_CONFIDENCE:\s*([\d]+\.[\d]+)", response_text, re.IGNORECASE)
-
-            # Take the last match (most final answer)
-            status = status_matches[-1].lower() if status_matches else "unhealthy"
-            confidence = float(confidence_matches[-1]) if confidence_matches else 0.0
-            disease_name = disease_matches[-1].strip() if disease_matches else "Not Specified"
-            disease_confidence = float(disease_conf_matches[-1]) if disease_conf_matches else 0.0
-
-            # Set final values
-            disease = "None"
-            if status == "unhealthy" and disease_name.lower() != "none":
-                disease = disease_name
-
-            return {
-                "status": status,
-                "confidence": confidence,
-                "disease": disease,
-                "disease_confidence": disease_confidence
-            }
+            response_text = response_text.strip()
+            if response_text.startswith("{"):
+                # Drop anything streamed after the object before the connection closed
+                response_text = response_text[:response_text.rfind("}") + 1]
+
+            try:
+                data = orjson.loads(response_text)
+            except orjson.JSONDecodeError:
+                # Not JSON: the model answered with FIELD: value lines
+                return self._build_diagnosis(self._extract_fields(response_text))
+
+            diagnosis = DiagnosisResponse.model_validate(data)
+            return self._build_diagnosis(diagnosis.model_dump())
         except Exception as e:
             raise ValueError(f"Failed to parse AI response. Raw text: '{response_text}' Error: {e}")
+
+    def _parse_batch_response(self, response_text: str, count: int) -> List[Dict[str, Any]]:
+        """
+        Split a multi-image response on its ITEM separators and parse each
+        section. Raises ValueError unless every image got a STATUS.
+        """
+        if "</think>" in response_text:
+            response_text = response_text.split("</think>")[-1].strip()
+
+        # split() yields [preamble, number, section, number, section, ...]
+        parts = _ITEM_SEPARATOR_RE.split(response_text)
+        sections = {int(number): section for number, section in zip(parts[1::2], parts[2::2])}
+
+        results = []
+        for number in range(1, count + 1):
+            fields = self._extract_fields(sections.get(number, ""))
+            if "status" not in fields:
+                raise ValueError(
+                    f"Batch response has no diagnosis for item {number} of {count}. "
+                    f"Raw text: '{response_text}'"
+                )
+            results.append(self._build_diagnosis(fields))
+        return results
+
+    def _extract_fields(self, response_text: str) -> Dict[str, Any]:
+        """Parse line by line, falling back to regex if no STATUS line was found."""
+        fields = self._parse_lines(response_text)
+        if "status" not in fields:
+            fields = self._parse_regex(response_text)
+        return fields
+
+    def _build_diagnosis(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Apply defaults to parsed fields and build the diagnosis dict."""
+        status = fields.get("status", "unhealthy")
+        confidence = fields.get("confidence", 0.0)
+        disease_name = fields.get("disease", "Not Specified")
+        disease_confidence = fields.get("disease_confidence", 0.0)
+
+        # Set final values
+        disease = "None"
+        if status == "unhealthy" and disease_name.lower() != "none":
+            disease = disease_name
+
+        return {
+            "status": status,
+            "confidence": confidence,
+            "disease": disease,
+            "disease_confidence": disease_confidence
+        }
+
+    def _parse_lines(self, response_text: str) -> Dict[str, Any]:
+        """
+        Single pass over the response lines, dispatching on the field name.
+        Later lines win, so the most final answer is kept.
+        """
+        fields: Dict[str, Any] = {}
+        for line in response_text.splitlines():
+            key, sep, value = line.partition(":")
+            if not sep:
+                continue
+            key = key.strip(" *-#").upper()
+            value = value.strip(" *")
+
+            if key == "STATUS":
+                value = value.lower()
+                if value in ("healthy", "unhealthy"):
+                    fields["status"] = value
+            elif key in ("CONFIDENCE", "DISEASE_CONFIDENCE"):
+                try:
+                    fields[key.lower()] = float(value)
+                except ValueError:
+                    pass
+            elif key == "DISEASE" and value:
+                fields["disease"] = value
+        return fields
+
+    def _parse_regex(self, response_text: str) -> Dict[str, Any]:
+        """Fallback parse that finds the fields anywhere in the text."""
+        # Use findall to get all matches, then take the last one (most final)
+        status_matches = _STATUS_RE.findall(response_text)
+        confidence_matches = _CONF_RE.findall(response_text)
+        disease_matches = _DISEASE_RE.findall(response_text)
+        disease_conf_matches = _DISEASE_CONF_RE.findall(response_text)
+
+        fields: Dict[str, Any] = {}
+        if status_matches:
+            fields["status"] = status_matches[-1].lower()
+        if confidence_matches:
+            fields["confidence"] = float(confidence_matches[-1])
+        if disease_matches:
+            fields["disease"] = disease_matches[-1].strip()
+        if disease_conf_matches:
+            fields["disease_confidence"] = float(disease_conf_matches[-1])
+        return fields
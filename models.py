@@ -1,15 +1,22 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Literal
 
 
 class DiagnosisResponse(BaseModel):
     """Response model for skin diagnosis results."""
+    # Frozen so cached instances can be shared safely between requests
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     status: Literal["healthy", "unhealthy"]
     confidence: float = Field(ge=0.0, le=1.0, description="Confidence score between 0.0 and 1.0")
     disease: str = Field(description="Name of the disease if unhealthy, 'None' if healthy")
     disease_confidence: float = Field(ge=0.0, le=1.0, description="Disease confidence score between 0.0 and 1.0")
 
 
+# JSON schema for grammar-constrained model output, built once at import
+DIAGNOSIS_SCHEMA = DiagnosisResponse.model_json_schema()
+
+
 class ErrorResponse(BaseModel):
     """Error response model."""
     detail: str = Field(description="Error message")
@@ -1,78 +1,455 @@
-import base64
+import asyncio
+import contextlib
+import functools
+import hashlib
 import httpx
+from concurrent.futures import Executor
 from PIL import Image
 import io
-from typing import Dict, Any
+import logging
+import math
+import threading
+from cachetools import LRUCache
+from typing import Callable, Dict, Any, List, Optional
 import json
+import orjson
 import re
+from pydantic import ValidationError
+
+from models import DIAGNOSIS_SCHEMA, DiagnosisResponse
+
+try:
+    # SIMD (SSSE3/AVX2) base64; same output as the stdlib encoder
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    from base64 import b64encode as _b64encode
+
+try:
+    # SIMD BLAKE3 for cache keys; otherwise OpenSSL's SHA-256 (SHA-NI on modern CPUs)
+    from blake3 import blake3 as _hasher
+except ImportError:
+    _hasher = hashlib.sha256
+
+try:
+    # Both array-based image backends below need NumPy
+    import numpy as np
+except ImportError:
+    np = None
+
+_TURBOJPEG = None
+if np is not None:
+    try:
+        # libjpeg-turbo (SIMD DCT/Huffman) for the JPEG encode, typically several
+        # times faster than Pillow's bundled libjpeg
+        from turbojpeg import TJPF_RGB, TurboJPEG
+        _TURBOJPEG = TurboJPEG()
+    except (ImportError, OSError, RuntimeError):
+        # Package missing, or the libturbojpeg shared library couldn't be loaded
+        pass
+
+cv2 = None
+if np is not None:
+    try:
+        # OpenCV decodes with libjpeg-turbo and downscales with a SIMD INTER_AREA
+        # kernel straight into NumPy memory, skipping Pillow's intermediate images
+        import cv2
+    except ImportError:
+        pass
+
+logger = logging.getLogger(__name__)
 
 # This is the prompt that forces the AI to give us the
-# "classification" output you wanted.
+# "classification" output you wanted. The payload's "format" holds the
+# model to DIAGNOSIS_SCHEMA, so the answer can be parsed as JSON.
 PROMPT_TEMPLATE = """
 You are a specialized medical AI. Analyze the provided image of a skin condition.
-Respond *only* in the following format, with no other text:
-STATUS: [healthy/unhealthy]
-CONFIDENCE: [a float number between 0.0 and 1.0]
-DISEASE: [Name of disease, or "None"]
-DISEASE_CONFIDENCE: [a float number between 0.0 and 1.0, or 0.0]
+Respond *only* with a JSON object, with no other text:
+{"status": "healthy" or "unhealthy", "confidence": a float number between 0.0 and 1.0, "disease": "Name of disease, or None", "disease_confidence": a float number between 0.0 and 1.0, or 0.0}
 """
 
+OLLAMA_BASE_URL = "http://127.0.0.1:11434"
+
+# Connection pool shared by every OllamaClient, so creating a client per
+# request (e.g. via dependency injection) still reuses warm keep-alive
+# connections. Plain HTTP/1.1: HTTP/2 buys nothing without TLS on localhost.
+_SHARED_CLIENT = httpx.AsyncClient(
+    base_url=OLLAMA_BASE_URL,
+    timeout=httpx.Timeout(connect=2.0, read=60.0, write=10.0, pool=5.0),
+    # AsyncClient ignores limits= when given a transport, so set them here
+    transport=httpx.AsyncHTTPTransport(
+        retries=1,
+        limits=httpx.Limits(
+            max_connections=64, max_keepalive_connections=32, keepalive_expiry=300
+        )
+    )
+)
+
+# Diagnoses keyed by model names + image hash, shared by all clients.
+# Low-confidence answers aren't cached so a later model can re-evaluate them.
+DIAGNOSIS_CACHE_SIZE = 256
+CACHE_MIN_CONFIDENCE = 0.5
+_DIAGNOSIS_CACHE = LRUCache(maxsize=DIAGNOSIS_CACHE_SIZE)
+_DIAGNOSIS_CACHE_LOCK = threading.Lock()
+
+# Diagnoses currently running, by cache key, shared by all clients so
+# identical concurrent uploads make one model call even with per-request clients
+_INFLIGHT: Dict[str, asyncio.Task] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+# Pixel budget for uploads: ~1.3 MP encodes to roughly 500 KB at Q85 for
+# typical photos, so one resize + one encode replaces the old retry loop
+TARGET_PIXELS = 1_300_000
+JPEG_QUALITY = 85
+
+# Generation options for the vision call. The answer is a short JSON object,
+# so num_predict is small; num_ctx only needs room for the prompt plus the
+# image (a TARGET_PIXELS image is ~1.3K tokens for Qwen-VL), which keeps the
+# KV cache small enough for OLLAMA_NUM_PARALLEL slots. Greedy decoding
+# (temperature 0, top_k 1). num_gpu is the number of layers to offload;
+# 999 is more than any model has, so every layer goes to the GPU (-1 would
+# mean Ollama's automatic placement, which may keep layers on the CPU).
+OLLAMA_OPTIONS = {
+    "num_ctx": 2048,
+    "num_predict": 128,
+    "temperature": 0.0,
+    "top_k": 1,
+    "num_gpu": 999,
+}
+
+# Keep models loaded between requests instead of Ollama's 5 minute default
+KEEP_ALIVE = "30m"
+
+# Instructions for the text refinement. The diagnosis being refined is
+# appended after them, so this prefix is identical for every request and can
+# be evaluated (and cached by Ollama) while the vision model is still running.
+REFINEMENT_PROMPT = """
+You are a medical AI assistant. Below is a diagnosis made by a vision model.
+
+Please refine this diagnosis by:
+1. Confirming if this is a reasonable diagnosis for skin conditions
+2. Providing a more precise confidence score based on your medical knowledge
+3. Suggesting if this could be a different condition
+
+Respond with:
+REFINED_CONFIDENCE: [adjusted confidence 0.0-1.0]
+REASONING: [brief explanation]
+"""
+
+# Loading a model on the warmup ping can take a while on a cold start
+WARMUP_TIMEOUT = 120.0
+
+# Startup checks already done in this process, mapping (vision model, text
+# model or None) to whether both stay loaded together. Clients created per
+# request skip the blocking connection check, warmup and /api/ps probe.
+_STARTUP_RESULTS: Dict[tuple, bool] = {}
+_STARTUP_LOCK = threading.Lock()
+
+# JPEGs already within the pixel budget and this size are sent unmodified;
+# it is also the size limit enforced by strict_size
+PASSTHROUGH_MAX_BYTES = 500 * 1024
+
+# Fields of the plain-text answer format, each on its own "FIELD: value" line
+_FIELD_NAMES = frozenset(
+    {"STATUS", "CONFIDENCE", "DISEASE", "DISEASE_CONFIDENCE", "REFINED_CONFIDENCE", "REASONING"}
+)
+# Only used when a value isn't a bare number. \d+(?:\.\d+)? rather than
+# [\d.]+ so a trailing "." (e.g. "0.8.") still parses.
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _scan_fields(response_text: str) -> Dict[str, str]:
+    """
+    Map each field name to its value, keeping the first occurrence.
+    REASONING runs to the end of the text since it may span several lines.
+    """
+    fields: Dict[str, str] = {}
+    lines = response_text.splitlines()
+    for index, line in enumerate(lines):
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+        key = key.strip().upper()
+        if key not in _FIELD_NAMES or key in fields:
+            continue
+        if key == "REASONING":
+            value = "\n".join([value, *lines[index + 1:]])
+        value = value.strip()
+        if value:
+            fields[key] = value
+    return fields
+
+
+def _encode_jpeg(img: Image.Image, quality: int):
+    """Encode an RGB/L image as JPEG, returning a bytes-like object."""
+    if _TURBOJPEG is not None and img.mode == "RGB":
+        return _TURBOJPEG.encode(np.asarray(img), quality=quality, pixel_format=TJPF_RGB)
+
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format="JPEG", quality=quality)
+    # A view of the buffer rather than a getvalue() copy
+    return img_buffer.getbuffer()
+
+
+def _cv2_to_jpeg(image_bytes: bytes) -> Optional[bytes]:
+    """
+    Decode, scale to the pixel budget and JPEG-encode with OpenCV.
+    Returns None if OpenCV can't decode the image.
+    """
+    arr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if arr is None:
+        return None
+
+    height, width = arr.shape[:2]
+    scale = min(1.0, math.sqrt(TARGET_PIXELS / (width * height)))
+    if scale < 1.0:
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        arr = cv2.resize(arr, size, interpolation=cv2.INTER_AREA)
+
+    ok, jpeg = cv2.imencode(".jpg", arr, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return jpeg.tobytes() if ok else None
+
+
+def _forget_inflight(cache_key: str, task: asyncio.Task) -> None:
+    """Done callback removing a finished diagnosis from _INFLIGHT."""
+    with _INFLIGHT_LOCK:
+        if _INFLIGHT.get(cache_key) is task:
+            del _INFLIGHT[cache_key]
+
+
+def _ignore_result(task: asyncio.Task) -> None:
+    """Done callback that consumes a task's result or exception."""
+    if not task.cancelled():
+        task.exception()
+
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    """Leading number of a field value, or None if it doesn't start with one."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        number = _NUMBER_RE.match(value)
+        return float(number.group()) if number else None
+
+
 class OllamaClient:
-    """Handles communication with a local Ollama model"""
+    """
+    Handles communication with a local Ollama model.
+
+    Requests are async, so several diagnoses can be in flight at once. Start
+    the Ollama server with OLLAMA_NUM_PARALLEL > 1 (e.g. 4) so it actually
+    runs them in parallel instead of queueing them per model.
+    """
 
     def __init__(
-        self, vision_model: str = "qwen3-vl:2b", text_model: str = "llama3.2:3b"
+        self,
+        vision_model: str = "qwen3-vl:2b",
+        text_model: str = "llama3.2:3b",
+        strict_size: bool = False,
+        refine: bool = False,
+        client: Optional[httpx.AsyncClient] = None,
+        executor: Optional[Executor] = None
     ):
         """
         Initializes the client with both vision and text models.
-        Vision model analyzes images, text model provides additional analysis.
+        Vision model analyzes images; with refine, the text model then
+        re-scores the confidence of any disease it found (one extra
+        generation, off by default). With strict_size, images are re-encoded
+        until they are at most PASSTHROUGH_MAX_BYTES (500 KB).
+        `client` defaults to the module-wide connection pool.
+        Quantized tags (e.g. a q4_K_M build of the vision model) cut memory
+        bandwidth per token and leave room for more parallel requests.
+        Image preprocessing runs on `executor`, or the loop's default pool if None.
         """
         self.vision_model = vision_model
         self.text_model = text_model
-        self.base_url = "http://127.0.0.1:11434"
-        self.api_url = f"{self.base_url}/api/chat"
-        self.client = httpx.Client(timeout=60.0)
+        self.strict_size = strict_size
+        self.refine = refine
+        self.base_url = OLLAMA_BASE_URL
+        self.api_url = "/api/chat"
+        self.client = client or _SHARED_CLIENT
+        self.executor = executor
         self._check_connection()
 
     def _check_connection(self):
-        """Checks if the Ollama server is running."""
+        """
+        Checks if the Ollama server is running and warms up the models,
+        once per process for each model combination.
+        """
+        startup_key = (self.vision_model, self.text_model if self.refine else None)
+        with _STARTUP_LOCK:
+            if startup_key not in _STARTUP_RESULTS:
+                _STARTUP_RESULTS[startup_key] = self._run_startup_checks()
+            self._can_parallel = _STARTUP_RESULTS[startup_key]
+
+    def _run_startup_checks(self) -> bool:
+        """
+        Blocking health check and warmup. Returns whether refinement can
+        overlap the vision call.
+        """
         try:
-            response = self.client.get(self.base_url)
+            # One-off blocking request: __init__ can't await the async client
+            response = httpx.get(self.base_url, timeout=5.0)
             response.raise_for_status()
         except (httpx.ConnectError, httpx.HTTPStatusError) as e:
             raise Exception(f"Failed to connect to Ollama at {self.base_url}. Is it running? Error: {e}")
 
-    def diagnose_skin_image(self, image_bytes: bytes) -> Dict[str, Any]:
+        self._warm_up(self.vision_model, OLLAMA_OPTIONS)
+        if not self.refine:
+            return False
+        self._warm_up(self.text_model, {})
+        return self._both_models_loaded()
+
+    def _both_models_loaded(self) -> bool:
         """
-        Main method: takes image bytes, returns diagnosis dict using both vision and text models
+        Check via /api/ps whether the server kept both models resident after
+        warmup. Only then can refinement work overlap the vision call instead
+        of waiting for the vision model to be swapped out.
         """
         try:
-            # 1. Convert image
-            base64_image = self._image_to_base64(image_bytes)
-
-            # 2. Vision model analysis
-            vision_payload = self._build_vision_prompt(base64_image)
-            vision_response = self._call_ollama_api(
-                vision_payload, model=self.vision_model
+            response = httpx.get(self.base_url + "/api/ps", timeout=5.0)
+            response.raise_for_status()
+            loaded = {model.get("name") for model in response.json().get("models", [])}
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"Could not list loaded Ollama models: {e}")
+            return False
+
+        # Ollama reports untagged names with their implicit ":latest" tag
+        wanted = [m if ":" in m else f"{m}:latest" for m in (self.vision_model, self.text_model)]
+        if all(m in loaded for m in wanted):
+            return True
+
+        logger.warning(
+            f"Ollama did not keep {self.vision_model} and {self.text_model} loaded together, "
+            "so refinement runs strictly after the vision model. Set OLLAMA_MAX_LOADED_MODELS>=2 "
+            "(and OLLAMA_NUM_PARALLEL>1 for concurrent requests) on the server."
+        )
+        return False
+
+    def _warm_up(self, model: str, options: Dict[str, Any]) -> None:
+        """
+        Load a model with a one-token ping so the first diagnosis doesn't pay
+        the load time. `options` must match the model's real requests: Ollama
+        reloads the runner when num_ctx or num_gpu change. Failures are
+        logged; the real request will retry.
+        """
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": "ping"}],
+            "options": {**options, "num_predict": 1},
+            "keep_alive": KEEP_ALIVE,
+            "stream": False,
+        }
+        try:
+            response = httpx.post(
+                self.base_url + self.api_url, json=payload, timeout=WARMUP_TIMEOUT
             )
-            vision_data = self._parse_response(vision_response)
-
-            # 3. Optional text model refinement (if vision model found a disease)
-            if (
-                vision_data.get("status") == "unhealthy"
-                and vision_data.get("disease") != "None"
-            ):
-                text_payload = self._build_text_refinement_prompt(vision_data)
-                text_response = self._call_ollama_api(
-                    text_payload, model=self.text_model
-                )
-                text_data = self._parse_text_refinement(text_response)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Warmup of Ollama model {model} failed: {e}")
+
+    async def aclose(self) -> None:
+        """Close an injected HTTP client; the shared pool lives for the process."""
+        if self.client is not _SHARED_CLIENT:
+            await self.client.aclose()
 
-                # Combine results - use text model to refine confidence if available
-                if text_data.get("refined_confidence"):
-                    vision_data["disease_confidence"] = text_data["refined_confidence"]
+    async def diagnose_many(self, images: List[bytes]) -> List[Dict[str, Any]]:
+        """
+        Diagnose several images concurrently, returning one diagnosis dict
+        per image in order.
+        """
+        return await asyncio.gather(*(self.diagnose_skin_image(b) for b in images))
 
-            # 4. Return combined results
+    async def diagnose_skin_image(self, image_bytes: bytes) -> Dict[str, Any]:
+        """
+        Main method: takes image bytes, returns diagnosis dict using both vision and text models
+        """
+        cache_key = self._cache_key(
+            image_bytes,
+            self.vision_model,
+            self.text_model if self.refine else None,
+            self.strict_size
+        )
+        with _DIAGNOSIS_CACHE_LOCK:
+            cached = _DIAGNOSIS_CACHE.get(cache_key)
+        if cached is not None:
+            return dict(cached)
+
+        if self.client is not _SHARED_CLIENT:
+            # The shared task would run on this client's pool, which its owner
+            # may close while other callers still wait; don't coalesce
+            return dict(await self._diagnose_uncached(image_bytes, cache_key))
+
+        loop = asyncio.get_running_loop()
+        with _INFLIGHT_LOCK:
+            task = _INFLIGHT.get(cache_key)
+            # A task from another event loop can't be awaited here
+            if task is None or task.done() or task.get_loop() is not loop:
+                task = loop.create_task(self._diagnose_uncached(image_bytes, cache_key))
+                _INFLIGHT[cache_key] = task
+                task.add_done_callback(functools.partial(_forget_inflight, cache_key))
+
+        # Shielded so one caller going away doesn't cancel the others' diagnosis
+        return dict(await asyncio.shield(task))
+
+    async def _diagnose_uncached(self, image_bytes: bytes, cache_key: str) -> Dict[str, Any]:
+        """Run the model(s) on an image and cache a confident result."""
+        try:
+            # 1. Convert image (Pillow releases the GIL, so encodes run in parallel
+            # on the pool while the event loop keeps serving other requests)
+            loop = asyncio.get_running_loop()
+            base64_image = await loop.run_in_executor(
+                self.executor, self._image_to_base64, image_bytes
+            )
+
+            # Speculatively evaluate the fixed part of the refinement prompt
+            # on the text model while the vision model runs
+            prefill = None
+            if self.refine and self._can_parallel:
+                prefill = asyncio.create_task(self._call_ollama_api(
+                    self._build_text_prefill_prompt(), model=self.text_model
+                ))
+                # Its outcome is irrelevant; retrieve it so a failure isn't logged
+                # as "Task exception was never retrieved"
+                prefill.add_done_callback(_ignore_result)
+
+            try:
+                # 2. Vision model analysis
+                vision_payload = self._build_vision_prompt(base64_image)
+                vision_response = await self._call_ollama_api(
+                    vision_payload, model=self.vision_model, is_complete=self._has_all_fields
+                )
+                vision_data = self._parse_response(vision_response)
+
+                # 3. Optional text model refinement (if vision model found a disease)
+                if (
+                    self.refine
+                    and vision_data.get("status") == "unhealthy"
+                    and vision_data.get("disease") != "None"
+                ):
+                    if prefill:
+                        # Usually done already; the refinement then reuses its cached prefix
+                        with contextlib.suppress(Exception):
+                            await prefill
+
+                    text_payload = self._build_text_refinement_prompt(vision_data)
+                    text_response = await self._call_ollama_api(
+                        text_payload, model=self.text_model
+                    )
+                    text_data = self._parse_text_refinement(text_response)
+
+                    # Combine results - use text model to refine confidence if available
+                    if text_data.get("refined_confidence"):
+                        vision_data["disease_confidence"] = text_data["refined_confidence"]
+            finally:
+                if prefill and not prefill.done():
+                    prefill.cancel()  # Not needed; closing the request stops it on the server
+
+            # 4. Cache and return combined results
+            if vision_data["confidence"] >= CACHE_MIN_CONFIDENCE:
+                with _DIAGNOSIS_CACHE_LOCK:
+                    _DIAGNOSIS_CACHE[cache_key] = dict(vision_data)
             return vision_data
 
         except httpx.HTTPStatusError as e:
@@ -83,30 +460,59 @@ class OllamaClient:
             # Catch all other errors (parsing, etc.)
             raise Exception(f"An error occurred during analysis: {e}")
 
+    @staticmethod
+    def _cache_key(
+        image_bytes: bytes, vision_model: str, text_model: Optional[str], strict_size: bool
+    ) -> str:
+        """Cache key for an image under a given pair of models and preprocessing mode."""
+        return f"{vision_model}|{text_model}|{strict_size}|{_hasher(image_bytes).hexdigest()}"
+
     def _image_to_base64(self, image_bytes: bytes) -> str:
         """
         Convert image bytes to base64 string, resizing/compressing if needed.
         """
+        # Image.open only parses the header; pixels are decoded on demand
         img = Image.open(io.BytesIO(image_bytes))
 
-        if img.mode == 'RGBA':
+        # /api/chat only accepts base64 images, but a small JPEG can be
+        # encoded as-is, skipping the decode and re-encode entirely
+        width, height = img.size
+        if (
+            img.format == "JPEG"
+            and len(image_bytes) <= PASSTHROUGH_MAX_BYTES
+            and width * height <= TARGET_PIXELS
+        ):
+            return _b64encode(image_bytes).decode('ascii')
+
+        if cv2 is not None and not self.strict_size:
+            jpeg_data = _cv2_to_jpeg(image_bytes)
+            if jpeg_data is not None:
+                return _b64encode(jpeg_data).decode('ascii')
+
+        if img.mode not in ('RGB', 'L'):
             img = img.convert('RGB')
 
-        max_size_kb = 500
-        quality = 85
-        while True:
-            img_buffer = io.BytesIO()
-            img.save(img_buffer, format="JPEG", quality=quality)
-            size_kb = len(img_buffer.getvalue()) / 1024
+        if not self.strict_size:
+            # Scale straight to the pixel budget and encode once
+            width, height = img.size
+            scale = min(1.0, math.sqrt(TARGET_PIXELS / (width * height)))
+            if scale < 1.0:
+                img.thumbnail((int(width * scale), int(height * scale)), Image.LANCZOS)
 
-            if size_kb <= max_size_kb or quality <= 10:
-                break
+            jpeg_data = _encode_jpeg(img, JPEG_QUALITY)
+        else:
+            quality = JPEG_QUALITY
+            while True:
+                jpeg_data = _encode_jpeg(img, quality)
 
-            width, height = img.size
-            img = img.resize((int(width * 0.9), int(height * 0.9)), Image.LANCZOS)
-            quality -= 5
+                if len(jpeg_data) <= PASSTHROUGH_MAX_BYTES or quality <= 10:
+                    break
+
+                width, height = img.size
+                img = img.resize((int(width * 0.9), int(height * 0.9)), Image.LANCZOS)
+                quality -= 5
 
-        return base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+        return _b64encode(jpeg_data).decode('ascii')
 
     def _build_vision_prompt(self, base64_image: str) -> Dict[str, Any]:
         """Create the structured payload for vision model analysis"""
@@ -115,47 +521,121 @@ class OllamaClient:
             "messages": [
                 {"role": "user", "content": PROMPT_TEMPLATE, "images": [base64_image]}
             ],
-            "stream": False,
+            "format": DIAGNOSIS_SCHEMA,
+            "options": OLLAMA_OPTIONS,
+            "keep_alive": KEEP_ALIVE,
+            "stream": True,
         }
 
-    def _call_ollama_api(self, payload: Dict[str, Any], model: str = None) -> str:
-        """Send request to Ollama chat endpoint and get response"""
+    async def _call_ollama_api(
+        self,
+        payload: Dict[str, Any],
+        model: str = None,
+        is_complete: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        """
+        Send request to Ollama chat endpoint and get response. Streamed
+        replies arrive as one JSON object per line; if `is_complete` returns
+        True for the text received so far, the connection is closed, which
+        makes Ollama stop generating.
+        """
         if model:
             payload["model"] = model
 
-        response = self.client.post(self.api_url, json=payload)
-        response.raise_for_status()
+        parts: List[str] = []
+        # orjson passes the large base64 image string through in one copy
+        async with self.client.stream(
+            "POST",
+            self.api_url,
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"}
+        ) as response:
+            if response.is_error:
+                await response.aread()  # Make the error body available to callers
+            response.raise_for_status()
 
-        raw_data = response.json()
-        message = raw_data.get("message", {})
-        ai_text_response = message.get("content", "")
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                # Every normal chunk carries message.content, so index directly
+                # and only inspect the chunk when it doesn't (e.g. {"error": ...})
+                try:
+                    content = chunk["message"]["content"]
+                except (KeyError, TypeError):
+                    error = chunk.get("error") if isinstance(chunk, dict) else None
+                    raise ValueError(f"Unexpected Ollama response: {error or line}")
+
+                if content:
+                    parts.append(content)
+                    # Only a closing brace or a line break can complete the answer
+                    if (
+                        is_complete
+                        and ("}" in content or "\n" in content)
+                        and is_complete("".join(parts))
+                    ):
+                        break
+                if chunk.get("done"):
+                    break
+
+        ai_text_response = "".join(parts)
 
         if not ai_text_response:
             raise ValueError("AI returned an empty response.")
 
         return ai_text_response
 
+    def _has_all_fields(self, response_text: str) -> bool:
+        """True once the answer holds every diagnosis field."""
+        if response_text.lstrip().startswith("{"):
+            # The chunk holding the closing brace may carry a few more characters
+            try:
+                DiagnosisResponse.model_validate(
+                    orjson.loads(response_text[:response_text.rfind("}") + 1])
+                )
+                return True
+            except (orjson.JSONDecodeError, ValidationError):
+                return False
+
+        # Plain-text answer: the last line may still be cut off mid-value
+        complete_lines = response_text[:response_text.rfind("\n") + 1]
+        fields = _scan_fields(complete_lines)
+        return all(key in fields for key in ("STATUS", "CONFIDENCE", "DISEASE", "DISEASE_CONFIDENCE"))
+
     def _parse_response(self, response_text: str) -> Dict[str, Any]:
         """
-        Extract structured data from AI response using regex.
+        Extract structured data from AI response. The JSON answer is
+        validated against DiagnosisResponse, and a JSON answer that fails
+        validation is an error; anything else is read as "FIELD: value" lines.
         """
         try:
-            status_match = re.search(r"STATUS: (healthy|unhealthy)", response_text, re.IGNORECASE)
-            confidence_match = re.search(r"CONFIDENCE: ([\d\.]+)", response_text, re.IGNORECASE)
-            disease_match = re.search(r"DISEASE: ([^\n]+?)(?=\n|$)", response_text, re.IGNORECASE)
-            disease_conf_match = re.search(r"DISEASE_CONFIDENCE: ([\d\.]+)", response_text, re.IGNORECASE)
-
-            status = status_match.group(1).lower() if status_match else "unhealthy"
-            confidence = float(confidence_match.group(1)) if confidence_match else 0.0
+            text = response_text.strip()
+            if text.startswith("{"):
+                # Drop anything streamed after the object before the connection closed
+                text = text[:text.rfind("}") + 1]
+
+            try:
+                data = orjson.loads(text)
+            except orjson.JSONDecodeError:
+                # Not JSON: the model answered with FIELD: value lines
+                fields = _scan_fields(response_text)
+                status_value = fields.get("STATUS", "").lower()
+                status = "healthy" if status_value.startswith("healthy") else "unhealthy"
+                confidence = _to_float(fields.get("CONFIDENCE")) or 0.0
+                disease_name = fields.get("DISEASE", "Not Specified")
+                disease_confidence = _to_float(fields.get("DISEASE_CONFIDENCE")) or 0.0
+            else:
+                diagnosis = DiagnosisResponse.model_validate(data)
+                status = diagnosis.status
+                confidence = diagnosis.confidence
+                disease_name = diagnosis.disease
+                disease_confidence = diagnosis.disease_confidence
 
             disease = "None"
-            disease_confidence = 0.0
-
-            if status == "unhealthy":
-                disease_name = disease_match.group(1).strip() if disease_match else "Not Specified"
-                if disease_name.lower() != "none":
-                    disease = disease_name
-                    disease_confidence = float(disease_conf_match.group(1)) if disease_conf_match else 0.0
+            if status == "unhealthy" and disease_name.lower() != "none":
+                disease = disease_name
+            else:
+                disease_confidence = 0.0
 
             return {
                 "status": status,
@@ -173,39 +653,38 @@ class OllamaClient:
         disease = vision_data.get("disease", "Unknown")
         confidence = vision_data.get("disease_confidence", 0.0)
 
-        text_prompt = f"""
-You are a medical AI assistant. A vision model has diagnosed: {disease} with {confidence*100:.1f}% confidence.
-
-Please refine this diagnosis by:
-1. Confirming if this is a reasonable diagnosis for skin conditions
-2. Providing a more precise confidence score based on your medical knowledge
-3. Suggesting if this could be a different condition
-
-Respond with:
-REFINED_CONFIDENCE: [adjusted confidence 0.0-1.0]
-REASONING: [brief explanation]
-"""
+        text_prompt = (
+            REFINEMENT_PROMPT
+            + f"\nDiagnosis: {disease} with {confidence*100:.1f}% confidence.\n"
+        )
 
         return {
             "model": self.text_model,
             "messages": [{"role": "user", "content": text_prompt}],
+            "keep_alive": KEEP_ALIVE,
+            "stream": False,
+        }
+
+    def _build_text_prefill_prompt(self) -> Dict[str, Any]:
+        """
+        Payload that makes the text model evaluate REFINEMENT_PROMPT alone,
+        generating a single token, so the real refinement can reuse it.
+        """
+        return {
+            "model": self.text_model,
+            "messages": [{"role": "user", "content": REFINEMENT_PROMPT}],
+            "options": {"num_predict": 1},
+            "keep_alive": KEEP_ALIVE,
             "stream": False,
         }
 
     def _parse_text_refinement(self, response_text: str) -> Dict[str, Any]:
         """Parse the text model's refinement response"""
         try:
-            confidence_match = re.search(
-                r"REFINED_CONFIDENCE: ([\d\.]+)", response_text, re.IGNORECASE
-            )
-            reasoning_match = re.search(
-                r"REASONING: (.+)", response_text, re.IGNORECASE | re.DOTALL
-            )
+            fields = _scan_fields(response_text)
 
-            refined_confidence = (
-                float(confidence_match.group(1)) if confidence_match else None
-            )
-            reasoning = reasoning_match.group(1).strip() if reasoning_match else ""
+            refined_confidence = _to_float(fields.get("REFINED_CONFIDENCE"))
+            reasoning = fields.get("REASONING", "")
 
             return {"refined_confidence": refined_confidence, "reasoning": reasoning}
         except Exception as e:
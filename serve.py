@@ -0,0 +1,22 @@
+# Production entry point: `python serve.py`
+# For local development with auto-reload, use `python app.py` instead.
+
+import os
+import uvicorn
+
+if __name__ == "__main__":
+    # One worker per core by default; each worker has its own AI client,
+    # batcher and cache. WEB_CONCURRENCY overrides the count and is inherited
+    # by the workers, which split the cores between their image pools.
+    workers = int(os.environ.get("WEB_CONCURRENCY") or os.cpu_count() or 2)
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
+    )